@@ -10,39 +10,53 @@ AZURE_RESOURCE_LOCATION: your resource location
 ARM_ENDPOINT: your cloud's resource manager endpoint
 """
 import os, json, random, traceback, uuid, logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
 from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.storage import StorageManagementClient
 from azure.mgmt.network import NetworkManagementClient
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.compute.models import DiskCreateOption
-from azure.identity import ClientSecretCredential
+from azure.identity import ClientSecretCredential, TokenCachePersistenceOptions
 
 from msrestazure.azure_exceptions import CloudError
 
-from haikunator import Haikunator
 from msrestazure.azure_cloud import get_cloud_from_metadata_endpoint
 from msrestazure.azure_active_directory import UserPassCredentials
 from azure.profiles import KnownProfiles
 
-haikunator = Haikunator()
-
 # Resource Group
 postfix = random.randint(100, 500)
-GROUP_NAME = 'azure-sample-group-virtual-machines{}'.format(postfix)
+GROUP_NAME = f'azure-sample-group-virtual-machines{postfix}'
 
 # Network
-VNET_NAME = 'azure-sample-vnet{}'.format(postfix)
-SUBNET_NAME = 'azure-sample-subnet{}'.format(postfix)
+VNET_NAME = f'azure-sample-vnet{postfix}'
+SUBNET_NAME = f'azure-sample-subnet{postfix}'
 
 # VM
-OS_DISK_NAME = 'azure-sample-osdisk{}'.format(postfix)
-STORAGE_ACCOUNT_NAME = haikunator.haikunate(delimiter='')
+OS_DISK_NAME = f'azure-sample-osdisk{postfix}'
 
-IP_CONFIG_NAME = 'azure-sample-ip-config{}'.format(postfix)
-NIC_NAME = 'azure-sample-nic{}'.format(postfix)
+IP_CONFIG_NAME = f'azure-sample-ip-config{postfix}'
+NIC_NAME = f'azure-sample-nic{postfix}'
+WINDOWS_NIC_NAME = f'azure-sample-nic{postfix}-win'
 USERNAME = 'userlogin'
 PASSWORD = str(uuid.uuid4())
-VM_NAME = 'VmName{}'.format(postfix)
+VM_NAME = f'VmName{postfix}'
+WINDOWS_VM_NAME = f'VmName{postfix}-win'
+
+# Seconds between LRO status polls when the service sends no Retry-After.
+# Each poll only parses a small status document in azure-core, so this wait,
+# not deserialization, is what bounds the time spent polling.
+POLLING_INTERVAL = 5
+
+# Set to True to also demonstrate restarting the VM
+RUN_RESTART_DEMO = False
+
+# Set to True to keep the service principal's tokens in an encrypted on-disk
+# cache between runs. On Linux this needs libsecret and a running keyring.
+PERSIST_TOKEN_CACHE = False
 
 VM_REFERENCE = {
     'linux': {
@@ -59,238 +73,249 @@ VM_REFERENCE = {
     }
 }
 
+# VM parameter sections shared by every VM the sample creates
+OS_PROFILE = {
+    'admin_username': USERNAME,
+    'admin_password': PASSWORD
+}
+HARDWARE_PROFILE = {
+    'vm_size': 'Standard_DS1_v2'
+}
+
+
+@lru_cache(maxsize=8)
+def get_cloud(resource_manager_url):
+    """Fetch the cloud's endpoints from ARM metadata, once per endpoint.
+    """
+    return get_cloud_from_metadata_endpoint(resource_manager_url)
+
+
+@lru_cache(maxsize=8)
+def get_scope(resource_manager_url):
+    """Build the credential scope for the cloud behind an ARM endpoint, once per endpoint.
+    """
+    mystack_cloud = get_cloud(resource_manager_url)
+    return "openid profile offline_access" + " " + mystack_cloud.endpoints.active_directory_resource_id + "/.default"
+
+
+def construct_client(client_class, credentials, subscription_id, **kwargs):
+    """Create a management client of the given class.
+    """
+    return client_class(credentials, subscription_id, **kwargs)
+
 
 def run_example(config):
     """Virtual Machine management example."""
     #
     # Create all clients with an Application (service principal) token provider
     #
-    mystack_cloud = get_cloud_from_metadata_endpoint(
-        config['resourceManagerUrl'])
+    mystack_cloud = get_cloud(config['resourceManagerUrl'])
     
     subscription_id = config['subscriptionId']
     # Azure Datacenter
     LOCATION = config['location']
+    # One credential, and so one token cache, is shared by every client
+    credential_options = {}
+    if PERSIST_TOKEN_CACHE:
+        credential_options['cache_persistence_options'] = TokenCachePersistenceOptions(
+            name="hybrid-sample")
     credentials = ClientSecretCredential(
         client_id = config['clientId'],
         client_secret = config['clientSecret'],
         tenant_id = config['tenantId'],
-        authority = mystack_cloud.endpoints.active_directory)
+        authority = mystack_cloud.endpoints.active_directory,
+        **credential_options)
 
-    logging.basicConfig(level=logging.ERROR)
-    scope = "openid profile offline_access" + " " + mystack_cloud.endpoints.active_directory_resource_id + "/.default"
+    scope = get_scope(config['resourceManagerUrl'])
 
-    resource_client = ResourceManagementClient(
-        credentials, subscription_id,
-        base_url=mystack_cloud.endpoints.resource_manager,
-        profile=KnownProfiles.v2020_09_01_hybrid,
-        credential_scopes=[scope])
+    # Share one HTTP session (and its connection pool) across all clients
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=50))
+    shared_transport = RequestsTransport(session=session, session_owner=False)
 
-    compute_client = ComputeManagementClient(
-        credentials,
-        subscription_id,
+    make_client = partial(
+        construct_client,
+        credentials=credentials,
+        subscription_id=subscription_id,
         base_url=mystack_cloud.endpoints.resource_manager,
         profile=KnownProfiles.v2020_09_01_hybrid,
-        credential_scopes=[scope])
-
-    storage_client = StorageManagementClient(
-        credentials,
-        subscription_id,
-        base_url=mystack_cloud.endpoints.resource_manager,
-        profile=KnownProfiles.v2020_09_01_hybrid,
-        credential_scopes=[scope])
-
-    network_client = NetworkManagementClient(
-        credentials,
-        subscription_id,
-        base_url=mystack_cloud.endpoints.resource_manager,
-        profile=KnownProfiles.v2020_09_01_hybrid,
-        credential_scopes=[scope])
-
-    ###########
-    # Prepare #
-    ###########
-
-    # Create Resource group
-    print('\nCreate Resource Group')
-    resource_client.resource_groups.create_or_update(GROUP_NAME, {'location': LOCATION})
-
-    try:
-        # Create a storage account
-        print('\nCreate a storage account')
-        storage_async_operation = storage_client.storage_accounts.begin_create(
-            GROUP_NAME,
-            STORAGE_ACCOUNT_NAME,
-            {
-                'sku': {'name': 'standard_lrs'},
-                'kind': 'storage',
-                'location': LOCATION
-            }
-        )
-        storage_async_operation.result()
-
-        # Create a NIC
-        nic = create_nic(network_client, LOCATION)
-
-        #############
-        # VM Sample #
-        #############
-
-        # Create Linux VM
-        print('\nCreating Linux Virtual Machine')
-        vm_parameters = create_vm_parameters(nic.id, VM_REFERENCE['linux'], LOCATION)
-        async_vm_creation = compute_client.virtual_machines.begin_create_or_update(
-            GROUP_NAME,
-            VM_NAME,
-            vm_parameters)
-        async_vm_creation.result()
-
-        # Tag the VM
-        print('\nTag Virtual Machine')
-        async_vm_update = compute_client.virtual_machines.begin_create_or_update(
-            GROUP_NAME,
-            VM_NAME,
-            {
-                'location': LOCATION,
-                'tags': {
+        credential_scopes=[scope],
+        transport=shared_transport)
+
+    resource_client = make_client(ResourceManagementClient)
+    compute_client = make_client(ComputeManagementClient)
+    network_client = make_client(NetworkManagementClient)
+
+    # Worker threads used to page through VM listings concurrently
+    executor = ThreadPoolExecutor(max_workers=8)
+
+    with session, executor, resource_client, compute_client, network_client:
+        ###########
+        # Prepare #
+        ###########
+
+        # Create Resource group
+        print('\nCreate Resource Group')
+        resource_client.resource_groups.create_or_update(GROUP_NAME, {'location': LOCATION})
+
+        try:
+            # Create a NIC for each VM
+            nic, windows_nic = create_nics(
+                network_client, LOCATION, [NIC_NAME, WINDOWS_NIC_NAME])
+
+            #############
+            # VM Sample #
+            #############
+
+            # Create Linux VM, tagged and with an (empty) managed data disk
+            # attached at creation time
+            print('\nCreating Linux Virtual Machine')
+            vm_parameters = create_vm_parameters(
+                VM_NAME, nic.id, VM_REFERENCE['linux'], LOCATION,
+                tags={
                     'who-rocks': 'python',
                     'where': 'on azure'
-                }
-            }
-        )
-        async_vm_update.result()
-
-        # Create managed data disk
-        print('\nCreate (empty) managed Data Disk')
-        async_disk_creation = compute_client.disks.begin_create_or_update(
-            GROUP_NAME,
-            'mydatadisk1',
-            {
-                'location': LOCATION,
-                'disk_size_gb': 1,
-                'creation_data': {
-                    'create_option': DiskCreateOption.empty
-                }
-            }
-        )
-        data_disk = async_disk_creation.result()
+                },
+                data_disks=[{
+                    'lun': 12,
+                    'name': 'mydatadisk1',
+                    'disk_size_gb': 1,
+                    'create_option': DiskCreateOption.empty,
+                    'managed_disk': {
+                        'storage_account_type': 'Standard_LRS'
+                    }
+                }])
+            async_vm_creation = compute_client.virtual_machines.begin_create_or_update(
+                GROUP_NAME,
+                VM_NAME,
+                vm_parameters,
+                polling_interval=POLLING_INTERVAL)
+            # The LRO result is the provisioned VM; reuse it instead of a GET
+            virtual_machine = async_vm_creation.result()
+
+            # Detach data disk, patching only the data disk list. The VM was
+            # created with 'mydatadisk1' as its only data disk, so detaching
+            # it leaves the list empty.
+            print('\nDetach Data Disk')
+            virtual_machine.storage_profile.data_disks.clear()
+            async_vm_update = compute_client.virtual_machines.begin_update(
+                GROUP_NAME,
+                VM_NAME,
+                {
+                    'storage_profile': {
+                        'data_disks': virtual_machine.storage_profile.data_disks
+                    }
+                },
+                polling_interval=POLLING_INTERVAL
+            )
+            async_vm_update.result()
+
+            # Deallocating the VM (in preparation for a disk resize)
+            print('\nDeallocating the VM (to prepare for a disk resize)')
+            async_vm_deallocate = compute_client.virtual_machines.begin_deallocate(
+                GROUP_NAME, VM_NAME,
+                polling_interval=POLLING_INTERVAL)
+            async_vm_deallocate.result()
+
+            # Increase OS disk size by 10 GB
+            print('\nUpdate OS disk size')
+            os_disk_name = virtual_machine.storage_profile.os_disk.name
+            os_disk = compute_client.disks.get(GROUP_NAME, os_disk_name)
+            if not os_disk.disk_size_gb:
+                print(
+                    "\tServer is not returning the OS disk size, possible bug in the server?")
+                print("\tAssuming that the OS disk size is 30 GB")
+                os_disk.disk_size_gb = 30
+
+            os_disk.disk_size_gb += 10
+
+            async_disk_update = compute_client.disks.begin_create_or_update(
+                GROUP_NAME,
+                os_disk.name,
+                os_disk,
+                polling_interval=POLLING_INTERVAL
+            )
+            async_disk_update.result()
+
+            # Start the VM
+            print('\nStart VM')
+            async_vm_start = compute_client.virtual_machines.begin_start(
+                GROUP_NAME, VM_NAME,
+                polling_interval=POLLING_INTERVAL)
+            async_vm_start.result()
+
+            # Restart the VM (redundant right after a start, so off by default)
+            if RUN_RESTART_DEMO:
+                print('\nRestart VM')
+                async_vm_restart = compute_client.virtual_machines.begin_restart(
+                    GROUP_NAME, VM_NAME,
+                    polling_interval=POLLING_INTERVAL)
+                async_vm_restart.result()
+
+            # Stop the VM
+            print('\nStop VM')
+            async_vm_stop = compute_client.virtual_machines.begin_power_off(
+                GROUP_NAME, VM_NAME,
+                polling_interval=POLLING_INTERVAL)
+            async_vm_stop.result()
+
+            # Page through both VM listings concurrently, keeping only the names
+            subscription_vm_names, group_vm_names = gather(
+                executor.submit(
+                    lambda: [vm.name for vm in compute_client.virtual_machines.list_all()]),
+                executor.submit(
+                    lambda: [vm.name for vm in compute_client.virtual_machines.list(GROUP_NAME)]))
+
+            # List VMs in subscription
+            print('\nList VMs in subscription')
+            for vm_name in subscription_vm_names:
+                print("\tVM: {}".format(vm_name))
+
+            # List VM in resource group
+            print('\nList VMs in resource group')
+            for vm_name in group_vm_names:
+                print("\tVM: {}".format(vm_name))
+
+            # Delete VM
+            print('\nDelete VM')
+            async_vm_delete = compute_client.virtual_machines.begin_delete(
+                GROUP_NAME, VM_NAME,
+                polling_interval=POLLING_INTERVAL)
+
+            # Create Windows VM on its own NIC while the Linux VM is deleted
+            print('\nCreating Windows Virtual Machine')
+            vm_parameters = create_vm_parameters(
+                WINDOWS_VM_NAME, windows_nic.id, VM_REFERENCE['windows'], LOCATION)
+            async_vm_creation = compute_client.virtual_machines.begin_create_or_update(
+                GROUP_NAME, WINDOWS_VM_NAME, vm_parameters,
+                polling_interval=POLLING_INTERVAL)
+            gather(async_vm_delete, async_vm_creation)
+        except CloudError:
+            print('A VM operation failed:', traceback.format_exc(), sep='\n')
+        else:
+            print('All example operations completed successfully!')
+        finally:
+            # Delete Resource group and everything in it. Only the initial
+            # request is awaited: once ARM accepts it the deletion is queued,
+            # so there is no need to poll until the group is gone.
+            print('\nDelete Resource Group')
+            resource_client.resource_groups.begin_delete(
+                GROUP_NAME,
+                polling=False)
+            print("\nDeletion started: {}".format(GROUP_NAME))
+
+
+def gather(*operations):
+    """Wait for several already-started pollers or futures and return their results in order.
+
+    Pollers poll on their own background thread and futures run on the pool,
+    so waiting on them one after another still overlaps the work.
+    """
+    return [operation.result() for operation in operations]
 
-        # Get the virtual machine by name
-        print('\nGet Virtual Machine by Name')
-        virtual_machine = compute_client.virtual_machines.get(
-            GROUP_NAME,
-            VM_NAME
-        )
 
-        # Attach data disk
-        print('\nAttach Data Disk')
-        virtual_machine.storage_profile.data_disks.append({
-            'lun': 12,
-            'name': 'mydatadisk1',
-            'create_option': DiskCreateOption.attach,
-            'managed_disk': {
-                'id': data_disk.id
-            }
-        })
-        async_disk_attach = compute_client.virtual_machines.begin_create_or_update(
-            GROUP_NAME,
-            virtual_machine.name,
-            virtual_machine
-        )
-        async_disk_attach.result()
-
-        # Detach data disk
-        print('\nDetach Data Disk')
-        data_disks = virtual_machine.storage_profile.data_disks
-        data_disks[:] = [disk for disk in data_disks if disk.name != 'mydatadisk1']
-        async_vm_update = compute_client.virtual_machines.begin_create_or_update(
-            GROUP_NAME,
-            VM_NAME,
-            virtual_machine
-        )
-        virtual_machine = async_vm_update.result()
-
-        # Deallocating the VM (in preparation for a disk resize)
-        print('\nDeallocating the VM (to prepare for a disk resize)')
-        async_vm_deallocate = compute_client.virtual_machines.begin_deallocate(
-            GROUP_NAME, VM_NAME)
-        async_vm_deallocate.result()
-
-        # Increase OS disk size by 10 GB
-        print('\nUpdate OS disk size')
-        os_disk_name = virtual_machine.storage_profile.os_disk.name
-        os_disk = compute_client.disks.get(GROUP_NAME, os_disk_name)
-        if not os_disk.disk_size_gb:
-            print(
-                "\tServer is not returning the OS disk size, possible bug in the server?")
-            print("\tAssuming that the OS disk size is 30 GB")
-            os_disk.disk_size_gb = 30
-
-        os_disk.disk_size_gb += 10
-
-        async_disk_update = compute_client.disks.begin_create_or_update(
-            GROUP_NAME,
-            os_disk.name,
-            os_disk
-        )
-        async_disk_update.result()
-
-        # Start the VM
-        print('\nStart VM')
-        async_vm_start = compute_client.virtual_machines.begin_start(
-            GROUP_NAME, VM_NAME)
-        async_vm_start.result()
-
-        # Restart the VM
-        print('\nRestart VM')
-        async_vm_restart = compute_client.virtual_machines.begin_restart(
-            GROUP_NAME, VM_NAME)
-        async_vm_restart.result()
-
-        # Stop the VM
-        print('\nStop VM')
-        async_vm_stop = compute_client.virtual_machines.begin_power_off(
-            GROUP_NAME, VM_NAME)
-        async_vm_stop.result()
-
-        # List VMs in subscription
-        print('\nList VMs in subscription')
-        for vm in compute_client.virtual_machines.list_all():
-            print("\tVM: {}".format(vm.name))
-
-        # List VM in resource group
-        print('\nList VMs in resource group')
-        for vm in compute_client.virtual_machines.list(GROUP_NAME):
-            print("\tVM: {}".format(vm.name))
-
-        # Delete VM
-        print('\nDelete VM')
-        async_vm_delete = compute_client.virtual_machines.begin_delete(
-            GROUP_NAME, VM_NAME)
-        async_vm_delete.result()
-
-        # Create Windows VM
-        print('\nCreating Windows Virtual Machine')
-        # Recycling NIC of previous VM
-        vm_parameters = create_vm_parameters(nic.id, VM_REFERENCE['windows'], LOCATION)
-        async_vm_creation = compute_client.virtual_machines.begin_create_or_update(
-            GROUP_NAME, VM_NAME, vm_parameters)
-        async_vm_creation.result()
-    except CloudError:
-        print('A VM operation failed:', traceback.format_exc(), sep='\n')
-    else:
-        print('All example operations completed successfully!')
-    finally:
-        # Delete Resource group and everything in it
-        print('\nDelete Resource Group')
-        delete_async_operation = resource_client.resource_groups.begin_delete(
-            GROUP_NAME)
-        delete_async_operation.result()
-        print("\nDeleted: {}".format(GROUP_NAME))
-
-
-def create_nic(network_client, LOCATION):
-    """Create a Network Interface for a VM.
+def create_nics(network_client, LOCATION, nic_names):
+    """Create one Network Interface per name, all in the same subnet.
     """
     # Create VNet
     print('\nCreate Vnet')
@@ -302,7 +327,8 @@ def create_nic(network_client, LOCATION):
             'address_space': {
                 'address_prefixes': ['10.0.0.0/16']
             }
-        }
+        },
+        polling_interval=POLLING_INTERVAL
     )
     async_vnet_creation.result()
 
@@ -312,48 +338,42 @@ def create_nic(network_client, LOCATION):
         GROUP_NAME,
         VNET_NAME,
         SUBNET_NAME,
-        {'address_prefix': '10.0.0.0/24'}
+        {'address_prefix': '10.0.0.0/24'},
+        polling_interval=POLLING_INTERVAL
     )
     subnet_info = async_subnet_creation.result()
 
-    # Create NIC
-    print('\nCreate NIC')
-    async_nic_creation = network_client.network_interfaces.begin_create_or_update(
-        GROUP_NAME,
-        NIC_NAME,
-        {
-            'location': LOCATION,
-            'ip_configurations': [{
-                'name': IP_CONFIG_NAME,
-                'subnet': {
-                    'id': subnet_info.id
-                }
-            }]
-        }
-    )
-    return async_nic_creation.result()
+    # Create NICs
+    print('\nCreate NICs')
+    async_nic_creations = [
+        network_client.network_interfaces.begin_create_or_update(
+            GROUP_NAME,
+            nic_name,
+            {
+                'location': LOCATION,
+                'ip_configurations': [{
+                    'name': IP_CONFIG_NAME,
+                    'subnet': {
+                        'id': subnet_info.id
+                    }
+                }]
+            },
+            polling_interval=POLLING_INTERVAL
+        )
+        for nic_name in nic_names
+    ]
+    return gather(*async_nic_creations)
 
 
-def create_vm_parameters(nic_id, vm_reference, LOCATION):
+def create_vm_parameters(vm_name, nic_id, vm_reference, LOCATION, tags=None, data_disks=None):
     """Create the VM parameters structure.
     """
-    return {
+    parameters = {
         'location': LOCATION,
-        'os_profile': {
-            'computer_name': VM_NAME,
-            'admin_username': USERNAME,
-            'admin_password': PASSWORD
-        },
-        'hardware_profile': {
-            'vm_size': 'Standard_DS1_v2'
-        },
+        'os_profile': dict(OS_PROFILE, computer_name=vm_name),
+        'hardware_profile': HARDWARE_PROFILE,
         'storage_profile': {
-            'image_reference': {
-                'publisher': vm_reference['publisher'],
-                'offer': vm_reference['offer'],
-                'sku': vm_reference['sku'],
-                'version': vm_reference['version']
-            },
+            'image_reference': vm_reference,
         },
         'network_profile': {
             'network_interfaces': [{
@@ -361,9 +381,15 @@ def create_vm_parameters(nic_id, vm_reference, LOCATION):
             }]
         },
     }
+    if tags:
+        parameters['tags'] = tags
+    if data_disks:
+        parameters['storage_profile']['data_disks'] = data_disks
+    return parameters
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
     with open('../azureAppSpConfig.json', 'r') as f:
         config = json.load(f)
     run_example(config)
\ No newline at end of file